@@ -1,10 +1,59 @@
 import pandas as pd
 import numpy as np
+import functools
 import os
 
 from datetime import datetime
+from numba import njit, prange
 
 
+def _group_offsets(codes, n_groups):
+    """
+    Para codigos de grupo inteiros ordenados (ex: codigos do client_id categorico no nivel 0
+    do behavior_df), retorna (sizes, starts, pos_in_group): o tamanho e a linha inicial de
+    cada grupo, e a posicao de cada linha dentro do seu grupo.
+    """
+    sizes = np.bincount(codes, minlength = n_groups)
+    starts = sizes.cumsum() - sizes
+    pos_in_group = np.arange(len(codes)) - starts[codes]
+    return sizes, starts, pos_in_group
+
+
+@functools.lru_cache(maxsize = 32)
+def _make_kernel(term, window, take_diff):
+    """
+    Gera o kernel que processa cada cliente (bloco vol[starts[c]:starts[c] + sizes[c]]) numa unica passada:
+    descarta o termo incompleto (keep_month), copia os volumes de cada termo para uma linha de out_vol,
+    marca churn apenas no ultimo termo dos clientes churned (fix_churn) e, se window > 0, preenche
+    out_rm com a media movel dos window periodos anteriores (0 no primeiro periodo) ou, se take_diff,
+    com volume - media movel. As amostras do cliente c comecam na linha term_offsets[c].
+
+    term, window e take_diff sao constantes para o numba, e o kernel de cada configuracao eh
+    compilado uma unica vez e reaproveitado nas chamadas seguintes.
+    """
+    @njit(parallel = True)
+    def process_clients(starts, sizes, vol, client_churned, term_offsets, out_vol, out_churned, out_rm):
+        for c in prange(len(starts)):
+            n_terms = sizes[c] // term
+            start = starts[c]
+            rolling_sum = 0.0
+            for i in range(n_terms * term):
+                t = term_offsets[c] + i // term
+                j = i % term
+                out_vol[t, j] = vol[start + i]
+                if window > 0:
+                    # soma dos volumes em [i - window, i), sem incluir o periodo corrente
+                    if i > 0:
+                        rolling_sum += vol[start + i - 1]
+                    if i > window:
+                        rolling_sum -= vol[start + i - 1 - window]
+                    rm = rolling_sum / min(i, window) if i > 0 else 0.0
+                    out_rm[t, j] = vol[start + i] - rm if take_diff else rm
+            for k in range(n_terms):
+                out_churned[term_offsets[c] + k] = client_churned[c] and k == n_terms - 1
+
+    return process_clients
+
 def process_behavior(demgeo_df, behavior_df, 
                      client_id = 'bridge_company_id', 
                      filter_rows = {'last_recurrence' : 'Trimestral'}, 
@@ -106,136 +155,160 @@ def process_behavior(demgeo_df, behavior_df,
       demgeo_df[ demgeo_df[churn_date_col].notnull() ][became_date_col]).all(): 
         raise ValueError('existem datas churn nao nulas anteriores as datas became customer')
 
-    # seleciona colunas do demgeo_df
-    demgeo_df_listtokeep = [client_id, became_date_col, churn_date_col] 
+    # aplica restrição nas linhas do demgeo, com uma unica mascara para todas as colunas. 
+    # Ex: somente recorrencia trimestral
+    demgeo_mask = np.ones(len(demgeo_df), dtype = bool)
     if filter_rows is not None:
-        demgeo_df_listtokeep += [k for k in filter_rows]
-    demgeo_df = demgeo_df[demgeo_df_listtokeep].copy()
+        for col in filter_rows:
+            demgeo_mask &= demgeo_df[col].values == filter_rows[col]
 
-    # aplica restrição nas linhas do demgeo. 
-    # Ex: somente recorrencia trimestral
-    for col in filter_rows:
-        demgeo_df = demgeo_df[demgeo_df[col] == filter_rows[col]]
-        demgeo_df.drop(col, axis = 1, inplace = True)
+    # seleciona colunas do demgeo_df, com uma unica copia
+    demgeo_df = demgeo_df.loc[demgeo_mask, [client_id, became_date_col, churn_date_col]].copy()
+
+    # converte o client_id para categorico uma unica vez, com as mesmas categorias nos dois df's.
+    # os groupby's e as operacoes numpy seguintes usam os codigos inteiros, sem refatorar os ids
+    client_dtype = pd.CategoricalDtype(np.sort(demgeo_df[client_id].unique()))
+    n_clients = len(client_dtype.categories)
+    demgeo_df[client_id] = demgeo_df[client_id].astype(client_dtype)
+    behavior_df = behavior_df.assign(**{client_id: behavior_df[client_id].astype(client_dtype)})
 
     # restringindo clientes do behavior_df para os que permanecerem na base do demgeo_df
-    behavior_df = behavior_df[ behavior_df[client_id].isin(demgeo_df[client_id]) ]
+    # ids fora das categorias, i.e., fora do demgeo_df, recebem o codigo -1
+    behavior_df = behavior_df[behavior_df[client_id].cat.codes.values >= 0]
 
     # inserindo os clientes que nunca abriram issues. 
     # cria uma linha artificial contendo behavior_volume_col = 0, na data do became_customer 
-    ids_no_behavior = set(demgeo_df[client_id]) - set(behavior_df[client_id])
-    ids_no_behavior = demgeo_df[demgeo_df[client_id].isin(ids_no_behavior)].drop('churn_date', axis = 1)
-    ids_no_behavior.rename(columns = {'became_customer_date': behavior_date_col}, inplace = True)
+    # os clientes sem behavior sao as categorias cujo codigo nao aparece no behavior_df
+    no_behavior = np.bincount(behavior_df[client_id].cat.codes.values, minlength = n_clients) == 0
+    ids_no_behavior = demgeo_df.loc[no_behavior[demgeo_df[client_id].cat.codes.values], [client_id, became_date_col]]
+    ids_no_behavior = ids_no_behavior.rename(columns = {became_date_col: behavior_date_col})
     ids_no_behavior[behavior_volume_col] = 0
     behavior_df = pd.concat([behavior_df, ids_no_behavior])
 
     # agrupa segundo cliente e periodo, no momento apenas funciona com time_unit = 'MS'
     # ja que 'WS' nao funciona. ver TODO acima
     period_grouper = pd.Grouper(key = behavior_date_col, freq = time_unit)
-    behavior_df = behavior_df.groupby([client_id, period_grouper])[behavior_volume_col].sum()
-    behavior_df = behavior_df.to_frame()
+    behavior_df = behavior_df.groupby([client_id, period_grouper], observed = True)[behavior_volume_col].sum()
 
     # cria um ranges de datas, entre (data mais antiga: data mais recente: intervalo), para o reindex
     min_date = behavior_df.index.get_level_values(-1).min()
     max_date = behavior_df.index.get_level_values(-1).max()
     date_range = pd.date_range(start = min_date, end = max_date, freq = time_unit)
 
-    # reindexa o nivel -1, i.e., as datas
-    # importante: inclui fill_value = 0
-    reindex_last_level = lambda x: x.reset_index(-1).set_index(behavior_date_col).reindex(date_range, fill_value = 0)
-    behavior_df = behavior_df.groupby(level = 0).apply(reindex_last_level)
-
-    assert behavior_df.index.get_level_values(0).unique().shape == demgeo_df[client_id].unique().shape
-
-    # junta as colunas de became e churn
-    # note: join ao inves de concat, porque o behavior_df tem client_id no nivel 0
+    # reindexa o nivel -1, i.e., as datas, de uma so vez para todos os clientes
+    # os volumes sao espalhados numa matriz densa (cliente, periodo) iniciada com 0, o que equivale
+    # ao reindex com fill_value = 0 sem montar a tabela hash do MultiIndex
+    # os clientes seguem a ordem das categorias, de modo que os codigos ficam em blocos crescentes
+    client_codes = behavior_df.index.get_level_values(0).codes
+    period_codes = date_range.searchsorted(behavior_df.index.get_level_values(1))
+    # contagens inteiras em int32, para reduzir a memoria percorrida pelos passos seguintes
+    volume_dtype = np.int32 if behavior_df.dtype.kind in 'iub' else behavior_df.dtype
+    volume_2d = np.zeros((n_clients, len(date_range)), dtype = volume_dtype)
+    volume_2d[client_codes, period_codes] = behavior_df.values
+
+    client_ids = pd.CategoricalIndex(client_dtype.categories, dtype = client_dtype)
+    full_idx = pd.MultiIndex.from_product([client_ids, date_range], names = [client_id, behavior_date_col])
+    behavior_df = pd.DataFrame({behavior_volume_col: volume_2d.ravel()}, index = full_idx)
+
+    assert np.unique(client_codes).shape == demgeo_df[client_id].unique().shape
+
+    # apos o reindex cada cliente tem exatamente len(date_range) linhas, na ordem das datas.
+    # o periodo ativo vai do mes do became (inclusive) ate o mes do churn (exclusive), entao basta
+    # localizar esses meses em date_range uma vez por cliente, sem cumsum sobre o df inteiro
+    codes = behavior_df.index.get_level_values(0).codes.astype(np.intp)
+    sizes, starts, pos_in_group = _group_offsets(codes, n_clients)
+
+    # as colunas de became e churn nao sao juntadas ao behavior_df: sao guardadas em arrays por
+    # codigo de cliente e lidas com codes, sem o join
     # todo: checar duplicidades de client_id no demgeo
-    behavior_df = behavior_df.join(demgeo_df.set_index('bridge_company_id'))
+    demgeo_codes = demgeo_df[client_id].cat.codes.values
 
-    # transforma datas para o primeiro dia do mes
-    for col in [became_date_col, churn_date_col]:
-        behavior_df[col] = behavior_df[col].values.astype('datetime64[M]')
-        behavior_df[col + '_flag'] = behavior_df[col] == behavior_df.index.get_level_values(1)
-        behavior_df[col + '_flag'] = behavior_df[col + '_flag'].groupby(level = 0).cumsum()
+    # flag para indicar usuario churned
+    client_churned = np.zeros(n_clients, dtype = bool)
+    client_churned[demgeo_codes] = demgeo_df[churn_date_col].notnull().values
 
-    # flag para indicar usuario churned    
-    behavior_df['churned'] = behavior_df[churn_date_col].notnull()
-
-    # flag para indicar periodo ativo, gerado a partir do (cumsum became ) & (not cumsum churn)
-    behavior_df['active_flag'] = behavior_df[became_date_col + '_flag'] & ~behavior_df[churn_date_col + '_flag']
-
-    behavior_df.drop([became_date_col, churn_date_col, 
-                      became_date_col + '_flag', churn_date_col + '_flag'], axis = 1, inplace = True)
-
-    # apaga as linhas para os meses inativos, deletar 'active_flag' nao mais necessario
-    behavior_df = behavior_df[behavior_df.active_flag]
-    behavior_df.drop('active_flag', axis = 1, inplace = True)
+    date_months = date_range.values.astype('datetime64[M]')
+    flag_start = {}
+    for col in [became_date_col, churn_date_col]:
+        # transforma datas para o primeiro dia do mes. NaT (cliente ativo) nunca eh alcancado
+        col_months = demgeo_df[col].values.astype('datetime64[M]')
+        col_start = np.searchsorted(date_months, col_months)
+        # como no cumsum original, um mes anterior ao inicio de date_range nunca eh alcancado
+        col_start[np.isnat(col_months) | (col_months < date_months[0])] = len(date_range)
+        flag_start[col] = np.empty(n_clients, dtype = np.intp)
+        flag_start[col][demgeo_codes] = col_start
+
+    # flag para indicar periodo ativo, gerado a partir do (became flag) & (not churn flag)
+    active_flag = ((pos_in_group >= flag_start[became_date_col][codes]) &
+                   (pos_in_group < flag_start[churn_date_col][codes]))
+
+    # apaga as linhas para os meses inativos
+    behavior_df = behavior_df[active_flag]
+    codes = codes[active_flag]
 
     # simplificacao para obter o term. ver TODO periodos_a_descartar
     term_dict = {'Anual' : 12, 'Trimestral': 3, 'Mensal': 1, 'Semestral': 6}
     term = term_dict[filter_rows['last_recurrence']]
 
-    # remover os periodos de behavior que ocorrem no meio de um termo incompleto. ver docstring
-    keep_month_func = lambda x: (term * (len(x) // term)) * [True] + (len(x) % term) * [False]
-    behavior_df['keep_month'] = behavior_df.groupby(level = 0).churned.transform(keep_month_func)
-    behavior_df = behavior_df[behavior_df.keep_month]
-    behavior_df.drop('keep_month', axis = 1, inplace = True)
-
-    # para os clientes churned, manter True apenas no ultimo termo, True para todos termos anteriores
-    # para os clientes nao churned sera True para todos os termos
-    fix_churn_func = lambda x: (len(x) - 1) * [False] + [True] if x.iloc[0] == True else len(x) * [False]
-    behavior_df['churned'] = behavior_df.groupby(level = 0).churned.transform(fix_churn_func)
-
-    # inclui coluna com o termo
-    # sorted(list(range(len(x) // term)) * term) eh somente uma maneira nao otimizada para transformar
-    # [0,1,2,0,1,2,0,1,2] => [0,0,0,1,1,1,2,2,2]
-    behavior_df['term'] = behavior_df.groupby(level = 0).churned.transform(
-      lambda x: sorted(list(range(len(x) // term)) * term)).astype(int)
-
     # inclui as medias moveis, nao incluindo o mes corrente na media
     # ex: media movel dos tres ultimos meses 
+    window = 0
+    take_diff = False
     if rolling_window:
         if rolling_window < 0 : 
             rolling_window = abs(rolling_window)
             take_diff = True
-        else:
-            take_diff = False
+        window = rolling_window
         behavior_volume_col_rm = behavior_volume_col + '_rm' + str(rolling_window)
-        behavior_df[behavior_volume_col_rm] = behavior_df.groupby(level = 0)[behavior_volume_col].apply(
-            lambda x: x.rolling(rolling_window, min_periods = 1).mean().shift().fillna(0))
-        if take_diff:
-            behavior_df[behavior_volume_col_rm] = behavior_df[behavior_volume_col] - behavior_df[behavior_volume_col_rm]
-
-    # segmenta o behavior_df em diferentes amostras, uma para cada periodo
-    behavior_df['date'] = behavior_df.index.get_level_values(1)
 
-    behavior_agg_dict = {behavior_volume_col: lambda x: tuple(x),  # gera tuplas na celula  # todo: dict comprehension 
-                         behavior_volume_col_rm: lambda x: tuple(x),   # gera tuplas na celula
-                         'churned' : 'sum',
-                         'date': 'first',
-                         }
+    # behavior_df esta ordenado por (cliente, data), entao cada cliente eh um bloco contiguo de linhas.
+    # cada cliente gera sizes // term amostras, uma por termo completo, e os periodos do termo
+    # incompleto sao descartados. ver docstring
+    sizes, starts, _ = _group_offsets(codes, n_clients)
+    n_terms = sizes // term
+    term_offsets = n_terms.cumsum() - n_terms
+    n_samples = n_terms.sum()
+
+    # keep_month, fix_churn, term e medias moveis calculados numa unica passada por cliente
+    vol = behavior_df[behavior_volume_col].values
+    out_vol = np.empty((n_samples, term), dtype = vol.dtype)
+    out_rm = np.empty((n_samples if window else 0, term), dtype = np.float32)
+    out_churned = np.empty(n_samples, dtype = np.int8)
+    _make_kernel(term, window, take_diff)(starts, sizes, vol, client_churned, term_offsets,
+                                          out_vol, out_churned, out_rm)
 
-    behavior_df = behavior_df.groupby([behavior_df.index.get_level_values(0), 'term']).agg(behavior_agg_dict)
+    # segmenta o behavior_df em diferentes amostras, uma para cada periodo
+    # cliente e termo de cada amostra, ex: n_terms = [2, 3] => clientes [0,0,1,1,1], termos [0,1,0,1,2]
+    sample_clients = np.repeat(np.arange(n_clients), n_terms)
+    sample_terms = np.arange(n_samples) - term_offsets[sample_clients]
+    sample_rows = starts[sample_clients] + sample_terms * term
+    sample_terms = sample_terms.astype(np.int32)
+
+    term_idx = pd.MultiIndex.from_arrays([pd.Categorical.from_codes(sample_clients, dtype = client_dtype),
+                                          sample_terms],
+                                         names = [client_id, 'term'])
+    term_df = pd.DataFrame({'churned': out_churned,
+                            'date': behavior_df.index.get_level_values(1)[sample_rows]}, index = term_idx)
 
     # inclui termo
     if include_term:
-        behavior_df['term'] = behavior_df.index.get_level_values(1)
+        term_df['term'] = sample_terms
 
     # inclui mes
     if include_month:
-        behavior_df['month'] = behavior_df.date.apply(lambda x: x.month)
+        # datetime64[M] conta meses desde 1970-01, entao o mes do calendario sai direto do inteiro
+        months = (term_df.date.values.astype('datetime64[M]').view('int64') % 12 + 1).astype(np.int8)
         if type(include_month) is int:
-            behavior_df['month'] = behavior_df.month.apply(lambda x: (x + include_month) % 12)
-
-
-    # expande as tuplas para colunas
-    for col in [behavior_volume_col, behavior_volume_col_rm]: 
-        behavior_tmp = behavior_df[col].apply(pd.Series)
-        behavior_tmp.columns = [col + '_' + str(j) for j in behavior_tmp]
-        behavior_df = pd.concat([behavior_df.drop(col, axis = 1), behavior_tmp], axis = 1)
-        
-    # variavel churned de boolean para int
-    behavior_df['churned'] = behavior_df.churned.astype(int)
+            months = (months + include_month) % 12
+        term_df['month'] = months
+
+    # expande os volumes de cada termo para colunas
+    volume_dfs = [pd.DataFrame(out_vol, index = term_idx,
+                               columns = [behavior_volume_col + '_' + str(j) for j in range(term)])]
+    if window:
+        volume_dfs += [pd.DataFrame(out_rm, index = term_idx,
+                                    columns = [behavior_volume_col_rm + '_' + str(j) for j in range(term)])]
+    behavior_df = pd.concat([term_df] + volume_dfs, axis = 1)
 
     # separar entre treino e teste, criando uma coluna identificando treino/teste: train = True, test = False
     if split_by_date is not None: